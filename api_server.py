@@ -7,11 +7,12 @@ from __future__ import annotations
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 
 from services.ai_service import AIService
 
-app = FastAPI(title="PedagogicalAI Chat API")
+app = FastAPI(title="PedagogicalAI Chat API", default_response_class=ORJSONResponse)
 
 # 允许所有源（开发阶段）；生产环境请限定域名
 app.add_middleware(
@@ -0,0 +1,60 @@
+"""Persistent exact-match cache for prompt_tester responses.
+
+Keyed by the raw 32-byte SHA-256 of (model, system prompt, user prompt,
+temperature) and stored in a local SQLite file, so re-running the same prompt while iterating
+costs no tokens and no network round trip.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".llm_cache.sqlite3"))
+DEFAULT_TTL = 86400  # seconds
+
+# Simple telemetry for the current run
+stats = {"hits": 0, "misses": 0}
+
+_conn = None
+
+
+def _get_conn():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(CACHE_PATH)
+        # BLOB digests are half the size of hex keys; WITHOUT ROWID stores rows
+        # in the primary-key B-tree itself, so a lookup is one index probe.
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_responses "
+            "(key BLOB PRIMARY KEY, content TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID"
+        )
+    return _conn
+
+
+def make_key(model, system_prompt, user_prompt, temperature):
+    payload = json.dumps(
+        {"m": model, "sys": system_prompt, "usr": user_prompt, "t": temperature}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode()).digest()
+
+
+def get(key):
+    """Return the cached content for key, or None when missing/expired."""
+    row = _get_conn().execute(
+        "SELECT content FROM llm_responses WHERE key = ? AND expires_at > ?", (key, time.time())
+    ).fetchone()
+    if row is None:
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    return row[0]
+
+
+def set(key, content, ttl=DEFAULT_TTL):
+    conn = _get_conn()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_responses (key, content, expires_at) VALUES (?, ?, ?)",
+            (key, content, time.time() + ttl),
+        )
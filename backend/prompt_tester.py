@@ -1,49 +1,155 @@
+import asyncio
 import os
-from openai import OpenAI
-from dotenv import load_dotenv
+import sys
+from functools import lru_cache
 
-# 加载环境变量
-load_dotenv()
+import llm_cache
 
 # --- Configuration ---
 # Using OpenRouter to access various models
-api_key = os.getenv("OPENROUTER_API_KEY")
-if not api_key:
-    raise ValueError("❌ OPENROUTER_API_KEY not found in environment variables. Please set it in your .env file.")
-
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=api_key,
-)
+@lru_cache(maxsize=1)
+def get_client():
+    """The one OpenRouter client (and connection pool) shared by every request.
+
+    openai and dotenv are imported here, on the first request, so starting the
+    tester (or typing 'quit' straight away) doesn't pay for them.
+    """
+    from dotenv import load_dotenv
+    from openai import AsyncOpenAI
+
+    # 加载环境变量
+    load_dotenv()
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    if not api_key:
+        raise ValueError("❌ OPENROUTER_API_KEY not found in environment variables. Please set it in your .env file.")
+    return AsyncOpenAI(
+        base_url="https://openrouter.ai/api/v1",
+        api_key=api_key,
+        # 429s/timeouts are retried with exponential backoff + jitter
+        max_retries=5,
+    )
+
+# Client-side pacing so multi-model comparisons don't burst into OpenRouter's rate limit
+REQUESTS_PER_MINUTE = float(os.getenv("PROMPT_TESTER_RPM", "90"))
+_next_request_at = 0.0
+
+async def wait_for_rate_limit():
+    """Spaces request starts evenly at REQUESTS_PER_MINUTE."""
+    global _next_request_at
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    start_at = max(now, _next_request_at)
+    _next_request_at = start_at + 60.0 / REQUESTS_PER_MINUTE
+    if start_at > now:
+        await asyncio.sleep(start_at - now)
+
 # You can change the model here if you want to test others
 DEFAULT_MODEL = "openai/gpt-4"
 
-def get_gpt_response(system_prompt, user_prompt, model):
-    """Generic function to get a response from the language model."""
+RESPONSE_HEADER = "\n" + "=" * 20 + " MODEL RESPONSE " + "=" * 20
+RESPONSE_FOOTER = "=" * 58 + "\n"
+
+async def get_gpt_response(system_prompt, user_prompt, model, temperature=None):
+    """Generic function to get a response from the language model.
+
+    Deterministic runs (temperature 0) are served from / saved to the on-disk
+    cache in llm_cache.py; sampled runs always go to the model.
+    """
+    cache_key = None
+    if temperature == 0:
+        cache_key = llm_cache.make_key(model, system_prompt, user_prompt, temperature)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            print(f"\n--- Cached response for model: {model} ---")
+            return cached
+
     print(f"\n--- Sending to model: {model} ---")
     try:
-        completion = client.chat.completions.create(
+        request_kwargs = {}
+        if temperature is not None:
+            request_kwargs["temperature"] = temperature
+        await wait_for_rate_limit()
+        completion = await get_client().chat.completions.create(
             model=model,
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt},
             ],
+            **request_kwargs,
         )
-        return completion.choices[0].message.content
+        content = completion.choices[0].message.content
+        if cache_key is not None and content:
+            llm_cache.set(cache_key, content)
+        return content
     except Exception as e:
         return f"An error occurred: {e}"
 
+async def stream_gpt_response(system_prompt, user_prompt, model, temperature=None):
+    """Like get_gpt_response, but prints the reply token by token as it is generated."""
+    cache_key = None
+    if temperature == 0:
+        cache_key = llm_cache.make_key(model, system_prompt, user_prompt, temperature)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            print(f"\n--- Cached response for model: {model} ---")
+            print(cached)
+            return cached
+
+    print(f"\n--- Streaming from model: {model} ---")
+    parts = []
+    try:
+        request_kwargs = {}
+        if temperature is not None:
+            request_kwargs["temperature"] = temperature
+        await wait_for_rate_limit()
+        stream = await get_client().chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            stream=True,
+            **request_kwargs,
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                parts.append(delta)
+                print(delta, end="", flush=True)
+        print()
+    except Exception as e:
+        print(f"\nAn error occurred: {e}")
+        return None
+    content = "".join(parts)
+    if cache_key is not None and content:
+        llm_cache.set(cache_key, content)
+    return content
+
 def get_multiline_input(prompt_message):
     """Reads multi-line input from the user until they enter 'DONE' on a new line."""
     print(f"\nEnter {prompt_message} (type 'DONE' on a new line when you're finished):")
+    if sys.stdin.isatty():
+        def read_line():
+            return input("> ")
+    else:
+        # Piped input: read straight from the buffered stream, no per-line prompt
+        readline = sys.stdin.readline
+
+        def read_line():
+            line = readline()
+            if not line:
+                raise EOFError
+            return line.rstrip("\n")
+
     lines = []
     while True:
         try:
-            line = input("> ")
+            line = read_line()
             # Use .strip() to handle potential whitespace and case-insensitivity
-            if line.strip().upper() == 'DONE':
+            command = line.strip().upper()
+            if command == 'DONE':
                 break
-            if line.strip().upper() == 'QUIT':
+            if command == 'QUIT':
                 # Return a special value to signal quitting
                 return 'quit'
             lines.append(line)
@@ -51,7 +157,7 @@ def get_multiline_input(prompt_message):
             break
     return "\n".join(lines)
 
-def main():
+async def main():
     """Main loop to test prompts."""
     print("--- Prompt Engineering Tester ---")
     print("This tool now supports multi-line prompts.")
@@ -67,17 +173,40 @@ def main():
         if user_prompt == 'quit':
             break
             
-        model_to_use = input(f"\nEnter model name (or press Enter for default: {DEFAULT_MODEL}): \n> ").strip()
-        if not model_to_use:
-            model_to_use = DEFAULT_MODEL
-        if model_to_use.lower() == 'quit':
+        models_input = input(f"\nEnter model name(s), comma-separated to compare (or press Enter for default: {DEFAULT_MODEL}): \n> ").strip()
+        if models_input.lower() == 'quit':
             break
+        models = [m.strip() for m in models_input.split(",") if m.strip()] or [DEFAULT_MODEL]
+
+        temperature_input = input("\nEnter temperature (press Enter for the model default; 0 = deterministic, cached): \n> ").strip()
+        if temperature_input.lower() == 'quit':
+            break
+        try:
+            temperature = float(temperature_input) if temperature_input else None
+        except ValueError:
+            print(f"Invalid temperature '{temperature_input}', using the model default.")
+            temperature = None
+
+        if len(models) == 1:
+            # Single model: show the reply as it streams in instead of waiting for all of it
+            print(RESPONSE_HEADER)
+            await stream_gpt_response(system_prompt, user_prompt, models[0], temperature)
+            print(RESPONSE_FOOTER)
+            continue
+
+        # All models are queried concurrently; total wait is the slowest model, not the sum
+        responses = await asyncio.gather(
+            *(get_gpt_response(system_prompt, user_prompt, model, temperature) for model in models)
+        )
 
-        response = get_gpt_response(system_prompt, user_prompt, model_to_use)
+        for model, response in zip(models, responses):
+            print(RESPONSE_HEADER)
+            print(f"[{model}]")
+            print(response)
+            print(RESPONSE_FOOTER)
 
-        print("\n" + "="*20 + " MODEL RESPONSE " + "="*20)
-        print(response)
-        print("="*58 + "\n")
+    if llm_cache.stats["hits"] or llm_cache.stats["misses"]:
+        print(f"Cache: {llm_cache.stats['hits']} hits, {llm_cache.stats['misses']} misses")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    asyncio.run(main()) 
\ No newline at end of file
@@ -3,7 +3,8 @@ Configuration settings for the SQL Tutor application.
 """
 
 import os
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
 
 load_dotenv() # Loads environment variables from a .env file if it exists
@@ -17,12 +18,55 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 if not OPENROUTER_API_KEY:
     raise ValueError("OPENROUTER_API_KEY not found in environment variables. Please set it in your .env file.")
 
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+# Retries on 429/5xx/timeouts, with the SDK's exponential backoff + jitter
+# (and Retry-After when OpenRouter sends it), on the same pooled connections.
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+
+# Sync client (CLI tutor, API background threads) gets the same kind of
+# pooled HTTP/2 keep-alive transport as the async one below.
+HTTP_CLIENT = httpx.Client(
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+)
 CLIENT = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
+    base_url=OPENROUTER_BASE_URL,
     api_key=OPENROUTER_API_KEY,
+    http_client=HTTP_CLIENT,
+    max_retries=LLM_MAX_RETRIES,
+)
+# Async client used by the API server's async endpoints (including SSE streaming).
+# One process-wide HTTP/2 connection pool, so LLM calls reuse warm TLS
+# connections to OpenRouter; closed by the API server on shutdown.
+# Pool limits are sized for many concurrent students rather than httpx's
+# defaults (100 connections), and are overridable from the environment.
+ASYNC_HTTP_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    limits=httpx.Limits(
+        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "2000")),
+        max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "500")),
+    ),
+)
+ASYNC_CLIENT = AsyncOpenAI(
+    base_url=OPENROUTER_BASE_URL,
+    api_key=OPENROUTER_API_KEY,
+    http_client=ASYNC_HTTP_CLIENT,
+    max_retries=LLM_MAX_RETRIES,
 )
 MODEL = "openai/gpt-4o-mini"
 
+# --- LLM response cache (AIService, opt-in per call) ---
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))  # seconds
+DISABLE_LLM_CACHE = os.getenv("DISABLE_LLM_CACHE", "").lower() in ("1", "true", "yes")
+
+# --- API rate limiting (per client IP, token bucket; 0 disables) ---
+# Generous defaults: a classroom behind one NAT shares a single IP.
+RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "300"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "60"))
+
 # --- Application Constants ---
 EXIT_COMMANDS = ['quit', 'exit']
 HEADER_SEPARATOR = "=" * 60 
\ No newline at end of file
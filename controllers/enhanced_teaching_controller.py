@@ -2,23 +2,152 @@
 Enhanced teaching controller with comprehensive data tracking and user modeling.
 """
 
+import asyncio
 import json
+import logging
+import orjson
 import time
 import re
 import random
+import threading
 from typing import Optional, List, Dict
 from datetime import datetime
 from services.ai_service import AIService
 from services.grading_service import GradingService
 from services.firestore_service import (
-    get_client, add_document, update_document, get_document, 
-    delete_document, list_collection
+    get_client, add_document, update_document, get_document, get_documents,
+    delete_document, list_collection, query_collection, count_documents, new_batch,
+    average_field, transactional_update, stream_collection
 )
 from models.user_profile import UserProfile
 from utils.io_helpers import get_user_input, print_header
+from utils.time_helpers import now_stamp
 
 import uuid
 
+logger = logging.getLogger(__name__)
+
+# How long a user's roadmap progress read stays fresh in the controller (seconds)
+LEARNING_PROGRESS_TTL = 30
+
+STEP1_CONFIRM_MENU = "\n".join([
+    "\n" + "=" * 50,
+    "💡 Do you understand this analogy?",
+    "1. Yes, I understand - let's continue",
+    "2. No, please explain it differently",
+    "=" * 50,
+])
+
+# Step 4 grading rubrics. The rubric is the whole (static) system prompt and the
+# student's solution goes last in the user message, so the long shared prefix is
+# identical across calls and eligible for provider-side prompt caching.
+STEP4_CORRECTNESS_SYSTEM_PROMPT = """You are an expert SQL instructor evaluating solution correctness with a 4-level grading system.
+
+Analyze the SQL solution and classify correctness into one of four levels:
+
+- EXCELLENT: Query is correct and functional, demonstrates clear understanding of concepts, produces the expected output. Minor formatting issues are acceptable.
+- GOOD: Query is mostly correct and would work, with only small issues that don't affect core functionality
+- FAIR: Query has some correctness but contains errors that would prevent proper execution or affect output quality
+- POOR: Query has major errors, won't execute correctly, or shows fundamental misunderstanding
+
+**GENEROUS GRADING PRINCIPLES:**
+- If a query solves the problem correctly, favor EXCELLENT or GOOD ratings
+- Minor formatting issues (spacing, capitalization) should not prevent EXCELLENT ratings
+- Focus on whether the query demonstrates understanding and produces correct results
+- Be generous with students who show they understand the core concepts
+
+**Guidelines for simple queries (SELECT...FROM...WHERE):**
+- EXCELLENT: Correct logic, proper syntax, would execute and produce expected results
+- GOOD: Mostly correct with minor issues that don't affect core functionality  
+- FAIR: Has errors that would prevent execution or produce wrong results
+- POOR: Major structural problems or fundamental misunderstanding
+
+Return JSON with this exact structure:
+{
+  "correctness_level": "EXCELLENT" | "GOOD" | "FAIR" | "POOR",
+  "confidence": float (0.0 to 1.0),
+  "concepts_used": [list of SQL concepts identified],
+  "missing_concepts": [list of expected concepts not used],
+  "syntax_errors": [list of syntax issues if any],
+  "logic_errors": [list of logical issues if any],
+  "suggestions": [list of improvement suggestions],
+  "works_correctly": boolean,
+  "output_accuracy": float (0.0 to 1.0),
+  "quality_explanation": "Brief explanation of why this grade was assigned"
+}
+
+Focus on whether the query would work correctly and produce the expected output. Be generous with EXCELLENT ratings for solutions that correctly solve the problem, even if simple."""
+
+STEP4_STRUCTURE_SYSTEM_PROMPT = """You are an expert SQL instructor evaluating code structure and formatting with a 4-level grading system.
+
+Analyze the SQL code structure and classify into one of four levels:
+
+- EXCELLENT: Perfect formatting, proper indentation, each SQL clause on its own line, clear structure, readable and professional
+- GOOD: Well-structured code with minor formatting issues, mostly follows best practices, readable
+- FAIR: Basic structure present but has formatting issues, inconsistent spacing/indentation, acceptable but could improve
+- POOR: Poor structure, everything on one line or confusing layout, hard to read, needs significant improvement
+
+**Guidelines for simple queries (SELECT...FROM...WHERE):**
+- EXCELLENT: Perfect formatting with proper line breaks and indentation
+- GOOD: Decent structure with minor formatting issues
+- FAIR: Basic structure but needs formatting improvement
+- POOR: Poor or no formatting structure
+
+Return JSON with this exact structure:
+{
+  "structure_level": "EXCELLENT" | "GOOD" | "FAIR" | "POOR",
+  "has_proper_linebreaks": boolean,
+  "has_proper_indentation": boolean,
+  "follows_sql_guidelines": boolean,
+  "readability_score": float (0.0 to 1.0),
+  "feedback": [list of specific structure feedback],
+  "suggestions": [list of structure improvement suggestions],
+  "structure_explanation": "Brief explanation of why this grade was assigned"
+}
+
+Focus on formatting, line breaks, indentation, and overall code organization. Be generous with EXCELLENT ratings for well-formatted simple queries."""
+
+# Shape of a generated Step 4 challenge, enforced by the model at decode time.
+# Not strict: schema/sample_data are keyed by table names the model chooses.
+_STRING_LIST = {"type": "array", "items": {"type": "string"}}
+STEP4_CHALLENGE_SCHEMA = {
+    "name": "step4_challenge",
+    "strict": False,
+    "schema": {
+        "type": "object",
+        "required": ["title", "difficulty", "description", "scenario", "schema",
+                     "sample_data", "task", "expected_concepts", "hints"],
+        "properties": {
+            "title": {"type": "string"},
+            "difficulty": {"type": "string", "enum": ["EASY", "MEDIUM", "HARD"]},
+            "description": {"type": "string"},
+            "scenario": {"type": "string"},
+            "schema": {
+                "type": "object",
+                "additionalProperties": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "required": ["column", "type", "description"],
+                        "properties": {
+                            "column": {"type": "string"},
+                            "type": {"type": "string"},
+                            "description": {"type": "string"},
+                        },
+                    },
+                },
+            },
+            "sample_data": {
+                "type": "object",
+                "additionalProperties": {"type": "array", "items": {"type": "object"}},
+            },
+            "task": {"type": "string"},
+            "expected_concepts": _STRING_LIST,
+            "hints": _STRING_LIST,
+        },
+    },
+}
+
 
 class EnhancedTeachingController:
     """Enhanced controller with comprehensive user modeling and data tracking."""
@@ -38,11 +167,19 @@ class EnhancedTeachingController:
         self.session_start_time = None
         # Store Step 3 performance score for adaptive difficulty
         self.step3_score: float | None = None
+        # (topic, difficulty, asyncio.Task) for a Step 4 challenge generated ahead of time
+        self.step4_prefetch: tuple | None = None
+        # (fetched_at, concept_ids) from roadmap_progress; dropped whenever a step writes progress
+        self._learning_progress: tuple | None = None
         # Roadmap progress cache
         self.current_roadmap_step = 0
         # Store Step 1 analogy in memory for Step 2 access
         self.current_analogy: str | None = None
         self.current_topic: str | None = None
+        # Step 2 attempt counters keyed by interaction_id (avoids re-counting attempts per submit)
+        self.step2_attempt_counts: Dict[str, int] = {}
+        self.step4_attempt_counts: Dict[str, int] = {}
+        self._attempt_lock = threading.Lock()
     
     def _get_firestore_client(self):
         """Get Firestore client."""
@@ -57,25 +194,28 @@ class EnhancedTeachingController:
             concept_id = topic.upper().replace(" ", "_")
             self.concept_id = concept_id
             
-            # Get or create concept document
-            concept_doc = get_document("concepts", concept_id)
+            # Concept and current mastery in one read; all writes in one batch
+            concept_doc, mastery_doc = get_documents([
+                ("concepts", concept_id),
+                ("concept_mastery", f"{self.user_id}_{concept_id}"),
+            ])
+            current_mastery = mastery_doc.get("mastery_level", 0.0) if mastery_doc else 0.0
+            batch = new_batch()
+            
+            # Create concept document if missing
             if not concept_doc:
                 add_document("concepts", {
                     "concept_id": concept_id,
                     "concept_name": topic,
                     "category": "unknown"
-                }, concept_id)
+                }, concept_id, batch=batch)
             
             # Ensure user exists
             update_document("users", self.user_id, {
                 "user_id": self.user_id,
                 "name": user_profile.name,
                 "level": user_profile.level
-            })
-            
-            # Get current mastery level
-            mastery_doc = get_document("concept_mastery", f"{self.user_id}_{concept_id}")
-            current_mastery = mastery_doc.get("mastery_level", 0.0) if mastery_doc else 0.0
+            }, batch=batch)
             
             # Create new session
             self.session_id = 'session_' + str(uuid.uuid4())[:8]
@@ -85,7 +225,8 @@ class EnhancedTeachingController:
                 "concept_id": concept_id,
                 "mastery_before": current_mastery,
                 "timestamp": datetime.now().isoformat()
-            }, self.session_id)
+            }, self.session_id, batch=batch)
+            batch.commit()
             
             print(f"🔗 Enhanced Session: {self.session_id} for '{topic}' (current mastery: {current_mastery:.2f})")
             return self.session_id
@@ -94,26 +235,36 @@ class EnhancedTeachingController:
             print(f"❌ Database error: {e}")
             return None
     
+    def _get_known_concepts(self) -> List[str]:
+        """Concepts this user has mastered (mastery level > 0.5)."""
+        mastery_docs = query_collection(
+            "concept_mastery", [("user_id", "==", self.user_id), ("mastery_level", ">", 0.5)],
+            fields=["concept_id"],
+        )
+        return [doc.get("concept_id") for doc in mastery_docs]
+
     def _start_step(self, step_number: int, step_name: str) -> str:
         """Start step with enhanced tracking."""
-        self.current_step_start_time = time.time()
+        ts_ms, ts_iso = now_stamp()
+        self.current_step_start_time = ts_ms / 1000
         
         interaction_data = {
             "session_id": self.session_id,
             "step_number": step_number,
             "step_name": step_name,
-            "start_time": datetime.now().isoformat()
+            "start_time": ts_iso
         }
         
         # Generate a unique interaction ID
-        interaction_id = f"interaction_{self.session_id}_{step_number}_{int(time.time())}"
+        interaction_id = f"interaction_{self.session_id}_{step_number}_{ts_ms}"
         add_document("step_interactions", interaction_data, interaction_id)
         
         self.current_interaction_id = interaction_id
         return interaction_id
     
-    def _end_step(self, step_number: int, success: bool = True, metadata: dict = None):
-        """End step with enhanced tracking."""
+    def _end_step(self, step_number: int, success: bool = True, metadata: dict = None, batch=None):
+        """End step with enhanced tracking. The step interaction write goes into `batch`
+        when one is given; the roadmap progress write is best-effort and stays outside it."""
         if self.current_step_start_time is None:
             return
             
@@ -125,9 +276,10 @@ class EnhancedTeachingController:
             "duration": duration,
             "success": success,
             "metadata": json.dumps(metadata) if metadata else None
-        })
+        }, batch=batch)
 
         # --- Roadmap progress update ---
+        # Written directly (not batched) so a failure here can't fail the request
         try:
             # Update or insert progress
             progress_id = f"{self.user_id}_{self.concept_id}"
@@ -138,6 +290,8 @@ class EnhancedTeachingController:
             })
         except Exception:
             pass
+        finally:
+            self._learning_progress = None
         
         print(f"📊 Step {step_number} completed in {duration}s")
 
@@ -150,11 +304,7 @@ class EnhancedTeachingController:
         print_header(f"Step 1: Real-Life Analogy for '{topic}'")
         
         # Get user's learning history for personalization from Firestore
-        mastery_docs = list_collection("concept_mastery")
-        known_concepts = [
-            doc.get("concept_id") for doc in mastery_docs
-            if doc.get("user_id") == self.user_id and doc.get("mastery_level", 0) > 0.5
-        ]
+        known_concepts = self._get_known_concepts()
         
         # Enhanced analogy generation with regeneration support
         personalization_context = {
@@ -184,11 +334,7 @@ class EnhancedTeachingController:
             print(analogy)
             
             # Ask for understanding confirmation
-            print("\n" + "="*50)
-            print("💡 Do you understand this analogy?")
-            print("1. Yes, I understand - let's continue")
-            print("2. No, please explain it differently")
-            print("="*50)
+            print(STEP1_CONFIRM_MENU)
             
             reading_start = time.time()
             user_choice = get_user_input("Your choice (1 or 2): ").strip()
@@ -235,8 +381,8 @@ class EnhancedTeachingController:
         
         return final_analogy
 
-    def _generate_initial_analogy(self, topic: str, personalization_context: dict) -> str:
-        """Generate the initial analogy for Step 1."""
+    def _get_step1_prompts(self, topic: str, personalization_context: dict) -> tuple[str, str]:
+        """Build the (system, user) prompts for the initial Step 1 analogy."""
         system_prompt = """You are an expert SQL instructor who explains concepts using vivid, creative analogies and also guides learners to reflect metacognitively. Keep explanations concise, engaging, and clear for beginners. Always follow your analogy with 1-2 reflection questions prompting the learner to think about how the analogy relates to their prior knowledge or experiences."""
         
         user_prompt = f"""Explain the concept of {topic} using a vivid real-life analogy.
@@ -249,7 +395,11 @@ class EnhancedTeachingController:
     • "What part of this analogy makes the concept clearer for you?"
 - Make the analogy engaging, memorable, and relevant for a {personalization_context['user_level']} learner.
 - Optionally, use examples from everyday life, hobbies, or common experiences."""
-        
+        return system_prompt, user_prompt
+
+    def _generate_initial_analogy(self, topic: str, personalization_context: dict) -> str:
+        """Generate the initial analogy for Step 1."""
+        system_prompt, user_prompt = self._get_step1_prompts(topic, personalization_context)
         analogy = self.ai_service.get_response(system_prompt, user_prompt)
         
         # Store analogy in memory for Step 2 access
@@ -259,12 +409,13 @@ class EnhancedTeachingController:
         
         return analogy
 
-    def _save_step1_attempt(self, interaction_id: str, analogy: str, personalization_context: dict, regeneration_count: int, user_understood: Optional[bool]):
-        """Saves a single Step 1 analogy attempt to the database."""
+    def _save_step1_attempt(self, interaction_id: str, analogy: str, personalization_context: dict, regeneration_count: int, user_understood: Optional[bool], batch=None):
+        """Saves a single Step 1 analogy attempt to the database (or into `batch` when given)."""
         # Simplified reading time and comprehension for API version
         reading_time = 10 # Placeholder
         comprehension_indicator = "pending"
 
+        ts_ms, ts_iso = now_stamp()
         analogy_data = {
             "interaction_id": interaction_id,
             "analogy_presented": analogy,
@@ -275,12 +426,14 @@ class EnhancedTeachingController:
             "previous_concepts": json.dumps(personalization_context['previous_concepts']),
             "regeneration_attempt": regeneration_count,
             "user_understood": user_understood,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": ts_iso
         }
         
         # Generate unique ID for this analogy attempt
-        analogy_id = f"analogy_{interaction_id}_{regeneration_count}_{int(time.time())}"
-        add_document("step1_analogies", analogy_data, analogy_id)
+        analogy_id = f"analogy_{interaction_id}_{regeneration_count}_{ts_ms}"
+        add_document("step1_analogies", analogy_data, analogy_id, batch=batch)
+        # The last saved analogy is the one Step 2 should build on
+        self.current_analogy = analogy
 
     def _generate_regenerated_analogy(self, topic: str, personalization_context: dict, used_analogies: list) -> str:
         """Generate a different analogy when user doesn't understand the previous one."""
@@ -311,7 +464,7 @@ Please generate a fresh, completely different analogy that avoids the topics and
 - Make the analogy engaging, memorable, and relevant for a {personalization_context['user_level']} learner.
 - Optionally, use examples from everyday life, hobbies, or common experiences."""
         
-        print(f"\\n[DEBUG] Prompt sent to AI for regeneration:\\n---\\n{user_prompt}\\n---\\n")
+        logger.debug("Prompt sent to AI for regeneration:\n---\n%s\n---", user_prompt)
         
         analogy = self.ai_service.get_response(system_prompt, user_prompt, temperature=0.8)
         
@@ -469,47 +622,45 @@ Output JSON in this exact format:
         """
         # First, try to get from memory
         if self.current_analogy and self.current_topic == topic:
-            print(f"[DEBUG] Retrieved analogy from memory for topic: {topic}")
+            logger.debug("Retrieved analogy from memory for topic: %s", topic)
             return self.current_analogy
             
         # Fallback to Firestore lookup
-        print(f"[DEBUG] Analogy not in memory, trying Firestore lookup for topic: {topic}")
+        logger.debug("Analogy not in memory, trying Firestore lookup for topic: %s", topic)
         if self.session_id:
             try:
                 # First, find the Step 1 interaction for this session
-                step_interactions = list_collection("step_interactions")
-                step1_interaction = None
-                
-                for interaction in step_interactions:
-                    if (interaction.get("session_id") == self.session_id and 
-                        interaction.get("step_number") == 1):
-                        step1_interaction = interaction
-                        break
+                step1_interactions = query_collection(
+                    "step_interactions",
+                    [("session_id", "==", self.session_id), ("step_number", "==", 1)],
+                    limit=1
+                )
                 
-                if step1_interaction:
-                    interaction_id = step1_interaction.get("id")
+                if step1_interactions:
+                    interaction_id = step1_interactions[0].get("id")
                     
                     # Find the most recent analogy for this interaction
-                    analogies = list_collection("step1_analogies")
-                    latest_analogy = None
-                    
-                    for analogy in analogies:
-                        if analogy.get("interaction_id") == interaction_id:
-                            latest_analogy = analogy
-                            break
+                    analogies = query_collection(
+                        "step1_analogies",
+                        [("interaction_id", "==", interaction_id)],
+                        order_by="regeneration_attempt",
+                        descending=True,
+                        limit=1
+                    )
+                    latest_analogy = analogies[0] if analogies else None
                     
                     if latest_analogy:
                         analogy_text = latest_analogy.get("analogy_presented", "")
                         # Store in memory for future use
                         self.current_analogy = analogy_text
                         self.current_topic = topic
-                        print(f"[DEBUG] Retrieved analogy from Firestore and stored in memory")
+                        logger.debug("Retrieved analogy from Firestore and stored in memory")
                         return analogy_text
                         
             except Exception as e:
-                print(f"[DEBUG] Firestore lookup failed: {e}")
+                logger.debug("Firestore lookup failed: %s", e)
                 
-        print(f"[DEBUG] No analogy found in memory or Firestore")
+        logger.debug("No analogy found in memory or Firestore")
         return ""
 
     def run_step_2_prediction(self, topic: str, step_1_context: str, user_profile: UserProfile) -> None:
@@ -655,8 +806,8 @@ Requirements:
     def _generate_step2_question(self, topic: str, step_1_context: str) -> Optional[Dict]:
         """Generate a dynamic Step 2 question using GPT with improved prompts."""
         
-        # Check if we have a Step 1 analogy to reference
-        analogy_context = self.get_step1_analogy_for_step2(topic)
+        # Use the Step 1 analogy passed in by the caller, otherwise look it up (memory first, then DB)
+        analogy_context = step_1_context or self.get_step1_analogy_for_step2(topic)
         
         # Create improved system prompt for GPT-4-mini
         system_prompt = """You are an expert SQL instructor creating multiple-choice questions for beginner learners. Your goal is to generate a single, clear MCQ that tests understanding of the given SQL concept.
@@ -1009,33 +1160,63 @@ Provide appropriate feedback for this student's answer."""
 
     def _save_step2_attempt(self, interaction_id: str, attempt_number: int, user_answer: str, correct_answer: str, is_correct: bool) -> None:
         """Save a single Step 2 attempt."""
+        ts_ms, ts_iso = now_stamp()
         attempt_data = {
             "interaction_id": interaction_id,
             "attempt_number": attempt_number,
             "user_answer": user_answer,
             "correct_answer": correct_answer,
             "is_correct": is_correct,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": ts_iso
         }
         
         # Generate unique ID for this attempt
-        attempt_id = f"attempt_{interaction_id}_{attempt_number}_{int(time.time())}"
+        attempt_id = f"attempt_{interaction_id}_{attempt_number}_{ts_ms}"
         add_document("step2_attempts", attempt_data, attempt_id)
+        with self._attempt_lock:
+            # Never move the counter back past a number already reserved by a concurrent submit
+            self.step2_attempt_counts[interaction_id] = max(
+                self.step2_attempt_counts.get(interaction_id, 0), attempt_number
+            )
+
+    def _get_step2_attempt_count(self, interaction_id: str) -> int:
+        """Return how many Step 2 attempts have been made for an interaction.
+
+        The count is kept in memory and only seeded from Firestore the first
+        time an interaction is seen (e.g. after a server restart).
+        """
+        if interaction_id not in self.step2_attempt_counts:
+            try:
+                self.step2_attempt_counts[interaction_id] = count_documents(
+                    "step2_attempts", "interaction_id", interaction_id
+                )
+            except Exception as e:
+                print(f"Error checking attempts: {e}")
+                return 0
+        return self.step2_attempt_counts[interaction_id]
+
+    def _reserve_step2_attempt_number(self, interaction_id: str) -> int:
+        """Claim the next Step 2 attempt number for an interaction (see `_reserve_step4_attempt_number`)."""
+        with self._attempt_lock:
+            attempt_number = self._get_step2_attempt_count(interaction_id) + 1
+            self.step2_attempt_counts[interaction_id] = attempt_number
+            return attempt_number
 
     def _save_step2_session(self, interaction_id: str, question_data: Dict, result: Dict) -> None:
         """Save the complete Step 2 session data."""
+        ts_ms, ts_iso = now_stamp()
         session_data = {
             "interaction_id": interaction_id,
-            "question_data": json.dumps(question_data),
+            "question_data": orjson.dumps(question_data).decode(),
             "total_attempts": result['attempts'],
             "questions_tried": result['questions_tried'],
             "final_success": result['final_correct'],
             "total_time": result['total_time'],
-            "timestamp": datetime.now().isoformat()
+            "timestamp": ts_iso
         }
         
         # Generate unique ID for this session
-        session_id = f"session_{interaction_id}_{int(time.time())}"
+        session_id = f"session_{interaction_id}_{ts_ms}"
         add_document("step2_sessions", session_data, session_id)
 
     def run_step_3_writing_task(self, topic: str, step_1_context: str, user_profile: UserProfile) -> UserProfile:
@@ -1079,6 +1260,7 @@ Provide appropriate feedback for this student's answer."""
             analysis = self._analyze_query(query_text, topic)
             
             # Store attempt
+            ts_ms, ts_iso = now_stamp()
             attempt_data = {
                 "interaction_id": interaction_id,
                 "attempt_number": attempt_number,
@@ -1089,11 +1271,11 @@ Provide appropriate feedback for this student's answer."""
                 "time_since_start": int(time.time() - query_writing_start),
                 "char_count": len(query_text),
                 "word_count": len(query_text.split()),
-                "timestamp": datetime.now().isoformat()
+                "timestamp": ts_iso
             }
             
             # Generate unique ID for this query attempt
-            attempt_id = f"query_{interaction_id}_{attempt_number}_{int(time.time())}"
+            attempt_id = f"query_{interaction_id}_{attempt_number}_{ts_ms}"
             add_document("query_attempts", attempt_data, attempt_id)
             
             # Store in memory for session analysis
@@ -1137,6 +1319,7 @@ Provide appropriate feedback for this student's answer."""
         explanation_analysis = self._analyze_explanation(explanation_text, topic)
         
         # Store explanation
+        ts_ms, ts_iso = now_stamp()
         explanation_data = {
             "interaction_id": interaction_id,
             "explanation_text": explanation_text,
@@ -1145,11 +1328,11 @@ Provide appropriate feedback for this student's answer."""
             "clarity_score": explanation_analysis['clarity_score'],
             "accuracy_score": explanation_analysis['accuracy_score'],
             "writing_time": int(explanation_time),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": ts_iso
         }
         
         # Generate unique ID for this explanation
-        explanation_id = f"explanation_{interaction_id}_{int(time.time())}"
+        explanation_id = f"explanation_{interaction_id}_{ts_ms}"
         add_document("step3_explanations", explanation_data, explanation_id)
         
         # Update user profile and mastery
@@ -1299,39 +1482,39 @@ Provide appropriate feedback for this student's answer."""
         """Update concept mastery based on performance."""
         concept_id = concept.upper().replace(" ", "_")
         mastery_doc_id = f"{self.user_id}_{concept_id}"
+        previous = {}
+
+        def apply_attempt(mastery_doc: Optional[dict]) -> dict:
+            # Runs inside a Firestore transaction (may be retried on contention)
+            if mastery_doc:
+                previous["mastery"] = mastery_doc.get('mastery_level', 0.0)
+                total_attempts = mastery_doc.get('total_attempts', 0)
+                successful_attempts = mastery_doc.get('successful_attempts', 0)
+                new_total = total_attempts + 1
+                new_successful = successful_attempts + (1 if success else 0)
+            else:
+                previous["mastery"] = 0.0
+                new_total = 1
+                new_successful = 1 if success else 0
+            
+            # Calculate new mastery (simplified algorithm)
+            base_score = new_successful / new_total
+            attempt_penalty = max(0, (attempts - 1) * 0.1)  # Penalty for multiple attempts
+            new_mastery = min(1.0, base_score - attempt_penalty)
+            
+            return {
+                "user_id": self.user_id,
+                "concept_id": concept_id,
+                "mastery_level": new_mastery,
+                "total_attempts": new_total,
+                "successful_attempts": new_successful,
+                "last_updated": datetime.now().isoformat()
+            }
+
+        # Read-modify-write in one transaction: concurrent updates can't lose attempts
+        mastery_data = transactional_update("concept_mastery", mastery_doc_id, apply_attempt)
         
-        # Get current mastery
-        mastery_doc = get_document("concept_mastery", mastery_doc_id)
-        
-        if mastery_doc:
-            current_mastery = mastery_doc.get('mastery_level', 0.0)
-            total_attempts = mastery_doc.get('total_attempts', 0)
-            successful_attempts = mastery_doc.get('successful_attempts', 0)
-            new_total = total_attempts + 1
-            new_successful = successful_attempts + (1 if success else 0)
-        else:
-            current_mastery = 0.0
-            new_total = 1
-            new_successful = 1 if success else 0
-        
-        # Calculate new mastery (simplified algorithm)
-        base_score = new_successful / new_total
-        attempt_penalty = max(0, (attempts - 1) * 0.1)  # Penalty for multiple attempts
-        new_mastery = min(1.0, base_score - attempt_penalty)
-        
-        # Update or insert
-        mastery_data = {
-            "user_id": self.user_id,
-            "concept_id": concept_id,
-            "mastery_level": new_mastery,
-            "total_attempts": new_total,
-            "successful_attempts": new_successful,
-            "last_updated": datetime.now().isoformat()
-        }
-        
-        update_document("concept_mastery", mastery_doc_id, mastery_data)
-        
-        print(f"📊 Mastery Update: {concept} = {new_mastery:.2f} (was {current_mastery:.2f})")
+        print(f"📊 Mastery Update: {concept} = {mastery_data['mastery_level']:.2f} (was {previous['mastery']:.2f})")
     
     def run_step_4_challenge(self, user_profile: UserProfile) -> UserProfile:
         """Enhanced Step 4 with adaptive challenge selection."""
@@ -1469,16 +1652,17 @@ Provide appropriate feedback for this student's answer."""
         # else pass and continue
 
         # Store overall challenge summary in Firestore
+        ts_ms, ts_iso = now_stamp()
         challenge_doc = {
             "interaction_id": interaction_id,
             "problem_difficulty": challenge_difficulty,
             "concepts_tested": json.dumps(user_profile.learned_concepts),
             "final_success": final_success,
             "total_solving_time": int(total_time),
-            "timestamp": datetime.now().isoformat()
+            "timestamp": ts_iso
         }
         
-        challenge_id = f"challenge_{interaction_id}_{int(time.time())}"
+        challenge_id = f"challenge_{interaction_id}_{ts_ms}"
         add_document("step4_challenges", challenge_doc, challenge_id)
          
         self._end_step(4, final_success, {
@@ -1499,14 +1683,9 @@ Provide appropriate feedback for this student's answer."""
             else:
                 return "EASY"    # 0-49 points → Easy
 
-        # Fallback to concept mastery average (original logic)
-        mastery_docs = list_collection("concept_mastery")
-        user_masteries = [
-            doc.get("mastery_level", 0.0) for doc in mastery_docs
-            if doc.get("user_id") == self.user_id and doc.get("mastery_level") is not None
-        ]
-        
-        avg_mastery = sum(user_masteries) / len(user_masteries) if user_masteries else 0.0
+        # Fallback to concept mastery average (original logic), averaged by Firestore
+        # instead of pulling every mastery document
+        avg_mastery = average_field("concept_mastery", [("user_id", "==", self.user_id)], "mastery_level") or 0.0
 
         if avg_mastery > 0.8:
             return "HARD"
@@ -1515,11 +1694,11 @@ Provide appropriate feedback for this student's answer."""
         else:
             return "EASY"
 
-    def _generate_step4_challenge(self, topic: str, difficulty: str, user_concepts: List[str]) -> Dict:
+    async def _generate_step4_challenge(self, topic: str, difficulty: str, user_concepts: List[str]) -> Dict:
         """Generate a dynamic Step 4 challenge based on difficulty level and user's learning progress."""
         
-        # Get user's learning progress to determine available concepts
-        user_progress = self._get_user_learning_progress()
+        # Get user's learning progress to determine available concepts (Firestore call, off the event loop)
+        user_progress = await asyncio.to_thread(self._get_user_learning_progress)
         available_concepts = self._get_available_concepts(user_progress, topic)
         
         # Define concept-specific requirements based on curriculum roadmap
@@ -1637,31 +1816,40 @@ EXAMPLE for SELECT/FROM level:
 
 Return only valid JSON, no additional text."""
 
-        try:
-            response = self.ai_service.get_response(system_prompt, user_prompt)
-            if response:
-                challenge_data = json.loads(response)
-                # Add metadata
-                challenge_data["generated_for_score"] = self.step3_score
-                challenge_data["user_concepts"] = user_concepts
-                return challenge_data
-        except (json.JSONDecodeError, Exception) as e:
-            print(f"Error generating Step 4 challenge: {e}")
-            return self._get_fallback_step4_challenge(difficulty, topic)
+        response = await self.ai_service.get_response_async(
+            system_prompt, user_prompt, json_schema=STEP4_CHALLENGE_SCHEMA
+        )
+        if response:
+            try:
+                challenge_data = orjson.loads(response)
+                # The schema isn't strict: valid JSON may still not be an object
+                if isinstance(challenge_data, dict):
+                    # Add metadata
+                    challenge_data["generated_for_score"] = self.step3_score
+                    challenge_data["user_concepts"] = user_concepts
+                    return challenge_data
+                print(f"Error generating Step 4 challenge: expected a JSON object, got {type(challenge_data).__name__}")
+            except Exception as e:
+                print(f"Error generating Step 4 challenge: {e}")
+        return await asyncio.to_thread(self._get_fallback_step4_challenge, difficulty, topic)
 
     def _get_user_learning_progress(self) -> List[str]:
         """Get user's completed concepts from Firestore or default to basic concepts."""
+        cached = self._learning_progress
+        if cached and time.monotonic() - cached[0] < LEARNING_PROGRESS_TTL:
+            return list(cached[1])
         try:
-            # Get all roadmap progress documents
-            progress_docs = list_collection("roadmap_progress")
-            
-            # Filter for this user's progress
+            # Get this user's roadmap progress documents
+            progress_docs = query_collection(
+                "roadmap_progress", [("user_id", "==", self.user_id)], fields=["concept_id"]
+            )
             user_progress = [
                 doc.get("concept_id") for doc in progress_docs
-                if doc.get("user_id") == self.user_id and doc.get("concept_id")
+                if doc.get("concept_id")
             ]
             
             if user_progress:
+                self._learning_progress = (time.monotonic(), list(user_progress))
                 return user_progress
             
         except Exception as e:
@@ -1939,7 +2127,7 @@ Return only valid JSON, no additional text."""
             question_doc = {
                 "question_id": question_id,
                 "interaction_id": interaction_id,
-                "question_data": json.dumps(question_data),
+                "question_data": orjson.dumps(question_data).decode(),
                 "difficulty": question_data.get('difficulty', 'MEDIUM'),
                 "step3_score": self.step3_score or 60,
                 "timestamp": datetime.now().isoformat()
@@ -1947,16 +2135,24 @@ Return only valid JSON, no additional text."""
             
             # Insert the question
             add_document("step4_questions", question_doc, question_id)
+            # A fresh interaction has no attempts yet; saves a count query on first submit
+            self.step4_attempt_counts.setdefault(interaction_id, 0)
             return question_id
         except Exception as e:
             print(f"Error saving Step 4 question: {e}")
             return question_id
 
+    @staticmethod
+    def load_step4_question_data(question_doc: dict) -> dict:
+        """Decode a step4_questions document's challenge JSON string."""
+        return orjson.loads(question_doc.get("question_data", "{}"))
+
     def _save_step4_attempt(self, interaction_id: str, attempt_number: int, user_solution: str, 
-                           feedback: str, is_correct: bool, feedback_type: str) -> None:
-        """Save Step 4 attempt to Firestore."""
+                           feedback: str, is_correct: bool, feedback_type: str, batch=None) -> None:
+        """Save Step 4 attempt to Firestore. The write goes into `batch` when one is given."""
         try:
             # Prepare attempt document
+            ts_ms, ts_iso = now_stamp()
             attempt_doc = {
                 "interaction_id": interaction_id,
                 "attempt_number": attempt_number,
@@ -1964,36 +2160,60 @@ Return only valid JSON, no additional text."""
                 "feedback": feedback,
                 "is_correct": is_correct,
                 "feedback_type": feedback_type,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": ts_iso
             }
             
             # Generate unique ID for this attempt
-            attempt_id = f"attempt_{interaction_id}_{attempt_number}_{int(time.time())}"
-            add_document("step4_attempts", attempt_doc, attempt_id)
+            attempt_id = f"attempt_{interaction_id}_{attempt_number}_{ts_ms}"
+            add_document("step4_attempts", attempt_doc, attempt_id, batch=batch)
         except Exception as e:
             print(f"Error saving Step 4 attempt: {e}")
 
+    def _get_step4_attempt_count(self, interaction_id: str) -> int:
+        """Return how many Step 4 attempts have been made for an interaction (see `_get_step2_attempt_count`)."""
+        if interaction_id not in self.step4_attempt_counts:
+            try:
+                self.step4_attempt_counts[interaction_id] = count_documents(
+                    "step4_attempts", "interaction_id", interaction_id
+                )
+            except Exception as e:
+                print(f"Error checking attempts: {e}")
+                return 0
+        return self.step4_attempt_counts[interaction_id]
+
+    def _reserve_step4_attempt_number(self, interaction_id: str) -> int:
+        """Claim the next Step 4 attempt number for an interaction.
+
+        Read and increment happen under one lock, so concurrent submits for the
+        same interaction never get the same number.
+        """
+        with self._attempt_lock:
+            attempt_number = self._get_step4_attempt_count(interaction_id) + 1
+            self.step4_attempt_counts[interaction_id] = attempt_number
+            return attempt_number
+
     def _save_step4_session(self, interaction_id: str, question_data: dict, total_attempts: int, 
                            final_success: bool, total_time: int) -> None:
         """Save Step 4 session summary to Firestore."""
         try:
             # Prepare session document
+            ts_ms, ts_iso = now_stamp()
             session_doc = {
                 "interaction_id": interaction_id,
-                "question_data": json.dumps(question_data),
+                "question_data": orjson.dumps(question_data).decode(),
                 "total_attempts": total_attempts,
                 "final_success": final_success,
                 "total_time": total_time,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": ts_iso
             }
             
             # Generate unique ID for this session
-            session_id = f"session_{interaction_id}_{int(time.time())}"
+            session_id = f"session_{interaction_id}_{ts_ms}"
             add_document("step4_sessions", session_doc, session_id)
         except Exception as e:
             print(f"Error saving Step 4 session: {e}")
 
-    def _generate_step4_feedback(self, user_solution: str, question_data: dict, overall_quality: str, evaluation: dict = None) -> str:
+    async def _generate_step4_feedback(self, user_solution: str, question_data: dict, overall_quality: str, evaluation: dict = None) -> str:
         """Generate AI-powered feedback for Step 4 solutions based on quality level."""
         
         task = question_data.get('task', 'SQL Challenge')
@@ -2116,7 +2336,7 @@ Their solution:
 Provide a helpful hint to guide them toward the correct solution."""
 
         try:
-            response = self.ai_service.get_response(system_prompt, user_prompt)
+            response = await self.ai_service.get_response_async(system_prompt, user_prompt)
             ai_feedback = response if response else f"Keep working on your {difficulty.lower()} SQL solution!"
             
             return ai_feedback
@@ -2124,18 +2344,18 @@ Provide a helpful hint to guide them toward the correct solution."""
             print(f"Error generating Step 4 feedback: {e}")
             return f"Good effort! Keep working on your SQL solution based on the {overall_quality.lower()} quality level."
 
-    def _evaluate_step4_solution(self, user_solution: str, question_data: dict) -> dict:
+    async def _evaluate_step4_solution(self, user_solution: str, question_data: dict) -> dict:
         """Evaluate Step 4 solution using detailed grading rubric."""
         
         task = question_data.get('task', 'SQL Challenge')
         expected_concepts = question_data.get('expected_concepts', [])
         difficulty = question_data.get('difficulty', 'MEDIUM')
         
-        # Phase 1: Get basic correctness evaluation
-        correctness_evaluation = self._evaluate_solution_correctness(user_solution, question_data)
-        
-        # Phase 2: Get code structure evaluation
-        structure_evaluation = self._evaluate_code_structure(user_solution)
+        # Phase 1 & 2: correctness and code structure evaluations are independent, run them concurrently
+        correctness_evaluation, structure_evaluation = await asyncio.gather(
+            self._evaluate_solution_correctness(user_solution, question_data),
+            self._evaluate_code_structure(user_solution)
+        )
         
         # Phase 3: Calculate scores based on rubric
         scores = self._calculate_step4_scores(correctness_evaluation, structure_evaluation, difficulty)
@@ -2167,73 +2387,42 @@ Provide a helpful hint to guide them toward the correct solution."""
             }
         }
 
-    def _evaluate_solution_correctness(self, user_solution: str, question_data: dict) -> dict:
+    async def _evaluate_solution_correctness(self, user_solution: str, question_data: dict) -> dict:
         """Evaluate solution correctness with improved 4-level grading."""
         
         task = question_data.get('task', 'SQL Challenge')
         expected_concepts = question_data.get('expected_concepts', [])
         difficulty = question_data.get('difficulty', 'MEDIUM')
-        
-        system_prompt = """You are an expert SQL instructor evaluating solution correctness with a 4-level grading system.
-
-Analyze the SQL solution and classify correctness into one of four levels:
-
-- EXCELLENT: Query is correct and functional, demonstrates clear understanding of concepts, produces the expected output. Minor formatting issues are acceptable.
-- GOOD: Query is mostly correct and would work, with only small issues that don't affect core functionality
-- FAIR: Query has some correctness but contains errors that would prevent proper execution or affect output quality
-- POOR: Query has major errors, won't execute correctly, or shows fundamental misunderstanding
-
-**GENEROUS GRADING PRINCIPLES:**
-- If a query solves the problem correctly, favor EXCELLENT or GOOD ratings
-- Minor formatting issues (spacing, capitalization) should not prevent EXCELLENT ratings
-- Focus on whether the query demonstrates understanding and produces correct results
-- Be generous with students who show they understand the core concepts
-
-**Guidelines for simple queries (SELECT...FROM...WHERE):**
-- EXCELLENT: Correct logic, proper syntax, would execute and produce expected results
-- GOOD: Mostly correct with minor issues that don't affect core functionality  
-- FAIR: Has errors that would prevent execution or produce wrong results
-- POOR: Major structural problems or fundamental misunderstanding
-
-Return JSON with this exact structure:
-{
-  "correctness_level": "EXCELLENT" | "GOOD" | "FAIR" | "POOR",
-  "confidence": float (0.0 to 1.0),
-  "concepts_used": [list of SQL concepts identified],
-  "missing_concepts": [list of expected concepts not used],
-  "syntax_errors": [list of syntax issues if any],
-  "logic_errors": [list of logical issues if any],
-  "suggestions": [list of improvement suggestions],
-  "works_correctly": boolean,
-  "output_accuracy": float (0.0 to 1.0),
-  "quality_explanation": "Brief explanation of why this grade was assigned"
-}"""
-
-        user_prompt = f"""Evaluate this SQL solution for correctness:
+        prompt_header = f"""Evaluate this SQL solution for correctness:
 
 Task: {task}
 Expected concepts: {', '.join(expected_concepts)}
 Difficulty: {difficulty}
 
 Student solution:
-{user_solution}
-
-Focus on whether the query would work correctly and produce the expected output. Be generous with EXCELLENT ratings for solutions that correctly solve the problem, even if simple."""
+"""
+        user_prompt = prompt_header + user_solution
+        # The grader sees the solution exactly as written. Only the cache key is
+        # normalized, and only by indentation/trailing spaces: line breaks are
+        # kept, since joining lines would swallow code after a -- comment.
+        cache_key = prompt_header + "\n".join(line.strip() for line in user_solution.strip().splitlines())
 
         try:
-            response = self.ai_service.get_response(system_prompt, user_prompt)
+            response = await self.ai_service.get_response_async(
+                STEP4_CORRECTNESS_SYSTEM_PROMPT, user_prompt, cache=True, cache_key=cache_key
+            )
             if response:
-                print(f"[DEBUG] AI evaluation response: {response[:200]}...")  # Log first 200 chars
+                logger.debug("AI evaluation response: %.200s...", response)
                 evaluation = json.loads(response)
-                print(f"[DEBUG] AI evaluation result: {evaluation.get('correctness_level', 'UNKNOWN')}")
+                logger.debug("AI evaluation result: %s", evaluation.get('correctness_level', 'UNKNOWN'))
                 return evaluation
             else:
-                print("[DEBUG] AI service returned empty response")
+                logger.debug("AI service returned empty response")
         except json.JSONDecodeError as e:
-            print(f"[DEBUG] JSON parsing error in AI evaluation: {e}")
-            print(f"[DEBUG] Raw AI response: {response}")
+            logger.debug("JSON parsing error in AI evaluation: %s", e)
+            logger.debug("Raw AI response: %s", response)
         except Exception as e:
-            print(f"[DEBUG] Error evaluating solution correctness: {e}")
+            logger.debug("Error evaluating solution correctness: %s", e)
         
         # Improved fallback evaluation using heuristics
         solution_upper = user_solution.upper().strip()
@@ -2282,44 +2471,15 @@ Focus on whether the query would work correctly and produce the expected output.
             "quality_explanation": explanation
         }
 
-    def _evaluate_code_structure(self, user_solution: str) -> dict:
+    async def _evaluate_code_structure(self, user_solution: str) -> dict:
         """Evaluate code structure quality with improved 4-level grading."""
         
-        system_prompt = """You are an expert SQL instructor evaluating code structure and formatting with a 4-level grading system.
-
-Analyze the SQL code structure and classify into one of four levels:
-
-- EXCELLENT: Perfect formatting, proper indentation, each SQL clause on its own line, clear structure, readable and professional
-- GOOD: Well-structured code with minor formatting issues, mostly follows best practices, readable
-- FAIR: Basic structure present but has formatting issues, inconsistent spacing/indentation, acceptable but could improve
-- POOR: Poor structure, everything on one line or confusing layout, hard to read, needs significant improvement
-
-**Guidelines for simple queries (SELECT...FROM...WHERE):**
-- EXCELLENT: Perfect formatting with proper line breaks and indentation
-- GOOD: Decent structure with minor formatting issues
-- FAIR: Basic structure but needs formatting improvement
-- POOR: Poor or no formatting structure
-
-Return JSON with this exact structure:
-{
-  "structure_level": "EXCELLENT" | "GOOD" | "FAIR" | "POOR",
-  "has_proper_linebreaks": boolean,
-  "has_proper_indentation": boolean,
-  "follows_sql_guidelines": boolean,
-  "readability_score": float (0.0 to 1.0),
-  "feedback": [list of specific structure feedback],
-  "suggestions": [list of structure improvement suggestions],
-  "structure_explanation": "Brief explanation of why this grade was assigned"
-}"""
-
         user_prompt = f"""Evaluate this SQL code structure:
 
-{user_solution}
-
-Focus on formatting, line breaks, indentation, and overall code organization. Be generous with EXCELLENT ratings for well-formatted simple queries."""
+{user_solution}"""
 
         try:
-            response = self.ai_service.get_response(system_prompt, user_prompt)
+            response = await self.ai_service.get_response_async(STEP4_STRUCTURE_SYSTEM_PROMPT, user_prompt, cache=True)
             if response:
                 evaluation = json.loads(response)
                 return evaluation
@@ -2462,22 +2622,27 @@ Focus on formatting, line breaks, indentation, and overall code organization. Be
     
     def end_session(self, user_profile: UserProfile):
         """End session with comprehensive analytics."""
+        if self.step4_prefetch:
+            # Nobody will pick up a Step 4 challenge generated for this session
+            self.step4_prefetch[2].cancel()
+            self.step4_prefetch = None
         if not self.session_id:
             return
         
         session_end_time = time.time()
         total_session_time = int(session_end_time - self.session_start_time)
         
-        # Calculate session metrics from Firestore
-        step_interactions = list_collection("step_interactions")
-        session_interactions = [
-            interaction for interaction in step_interactions
-            if interaction.get("session_id") == self.session_id
-        ]
-        
-        total_steps = len(session_interactions)
-        successful_steps = sum(1 for interaction in session_interactions if interaction.get("success"))
-        total_duration = sum(interaction.get("duration", 0) for interaction in session_interactions if interaction.get("duration"))
+        # Calculate session metrics from Firestore in one pass over the streamed documents
+        total_steps = successful_steps = total_duration = 0
+        # Only the two fields used (step_interactions also carry metadata JSON)
+        for interaction in stream_collection(
+            "step_interactions", [("session_id", "==", self.session_id)], fields=["success", "duration"]
+        ):
+            total_steps += 1
+            if interaction.get("success"):
+                successful_steps += 1
+            if interaction.get("duration"):
+                total_duration += interaction["duration"]
         
         # Calculate learning efficiency
         concepts_attempted = [self.concept_id] if self.concept_id else []
@@ -2491,16 +2656,17 @@ Focus on formatting, line breaks, indentation, and overall code organization. Be
         })
         
         # Store learning analytics
+        ts_ms, ts_iso = now_stamp()
         analytics_data = {
             "user_id": self.user_id,
             "session_id": self.session_id,
             "concepts_attempted": json.dumps(concepts_attempted),
             "learning_efficiency": learning_efficiency,
             "engagement_score": 0.85,  # Simplified engagement score
-            "timestamp": datetime.now().isoformat()
+            "timestamp": ts_iso
         }
         
-        analytics_id = f"analytics_{self.session_id}_{int(time.time())}"
+        analytics_id = f"analytics_{self.session_id}_{ts_ms}"
         add_document("learning_analytics", analytics_data, analytics_id)
         
         # Display session summary
@@ -1,8 +1,9 @@
 import os
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool
 
 # ---------------------------------------------------------------------------
 # Database configuration
@@ -14,11 +15,79 @@ DATABASE_URL = os.getenv(
     "sqlite:///pedagogical_ai.db",  # Changed to SQLite for testing
 )
 
-# Create SQLAlchemy engine. Pre-ping to avoid stale connections.
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+# Create SQLAlchemy engine.
+_engine_kwargs = {
+    # SQLAlchemy's compiled-SQL cache (default 500), shared by all connections
+    "query_cache_size": int(os.getenv("DB_QUERY_CACHE_SIZE", "1200")),
+}
+if DATABASE_URL.startswith("sqlite"):
+    # One process-wide pool of open file connections, shared by the API's worker
+    # threads, instead of re-opening the database (and its -wal/-shm files) per use.
+    _engine_kwargs.update(
+        poolclass=QueuePool,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+        max_overflow=0,
+        # A local file never goes stale; no SELECT 1 per checkout
+        pool_pre_ping=False,
+        # cached_statements: sqlite3's per-connection prepared statement cache
+        # (default 128) so repeated ORM INSERT/SELECTs skip re-compilation.
+        connect_args={"check_same_thread": False, "cached_statements": 256},
+    )
+else:
+    # Server databases (Postgres): keep enough warm connections that requests
+    # don't pay a TCP+TLS+auth handshake, and recycle them before server-side
+    # idle timeouts close them. Recycling replaces the per-checkout SELECT 1
+    # pre-ping (DB_POOL_PRE_PING=1 turns it back on, e.g. behind flaky proxies).
+    _engine_kwargs.update(
+        pool_size=int(os.getenv("DB_POOL_SIZE", "20")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "").lower() in ("1", "true", "yes"),
+    )
+    if DATABASE_URL.startswith("postgresql"):
+        # JIT compilation only pays off for long analytical queries. TCP
+        # keepalives let libpq notice a dead peer (failover, NAT timeout) in
+        # ~1 min instead of hanging until the OS-level default (~2 h).
+        _engine_kwargs["connect_args"] = {
+            "options": "-c jit=off",
+            "application_name": "pedagogical-ai",
+            "keepalives": 1,
+            "keepalives_idle": 30,
+            "keepalives_interval": 10,
+            "keepalives_count": 3,
+        }
 
-# Scoped session factory
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+engine = create_engine(DATABASE_URL, **_engine_kwargs)
+
+# Per-connection SQLite tuning, applied once when the pool opens a connection:
+# WAL so readers don't block on the writer, NORMAL sync (safe under WAL),
+# in-memory temp tables, 256 MiB mmap, 64 MiB page cache, 5 s lock wait.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=5000",
+)
+
+if engine.dialect.name == "sqlite":
+
+    @event.listens_for(engine, "connect")
+    def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in SQLITE_PRAGMAS:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+# Scoped session factory. Sessions from get_db_session are scoped to a block, so
+# objects are not expired on commit: reading user.user_id etc. right after a
+# commit must not cost a refresh SELECT. Long-lived sessions (StudentTracker)
+# opt back in with SessionLocal(expire_on_commit=True).
+SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False)
 
 # Declarative base for ORM models
 Base = declarative_base()
@@ -26,7 +95,12 @@ Base = declarative_base()
 
 @contextmanager
 def get_db_session():
-    """Provide a transactional scope around a series of operations."""
+    """Provide a transactional scope around a series of operations.
+
+    Always commits: bulk query().update()/delete() and session.execute(update(...))
+    bypass the unit of work, so "did this block write?" can't be told from the
+    session, and committing a read-only transaction costs next to nothing.
+    """
     session = SessionLocal()
     try:
         yield session
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, ForeignKey, JSON, func
+from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, ForeignKey, Index, JSON, func
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -6,6 +7,9 @@ from database import Base
 # ---------------------------------------------------------------------------
 # Core tables (MVP)
 # ---------------------------------------------------------------------------
+# Relationships are lazy="raise_on_sql": touching one that isn't loaded raises
+# instead of silently issuing a query per object (N+1). Load them explicitly,
+# e.g. query(LearningSession).options(selectinload(LearningSession.interactions)).
 
 class User(Base):
     __tablename__ = "users"
@@ -19,7 +23,7 @@ class User(Base):
     total_learning_time = Column(Integer, default=0)
     preferred_language = Column(String(10), default="en")
 
-    sessions = relationship("LearningSession", back_populates="user")
+    sessions = relationship("LearningSession", back_populates="user", lazy="raise_on_sql")
 
 
 class Concept(Base):
@@ -33,11 +37,13 @@ class Concept(Base):
     estimated_time = Column(Integer)
     description = Column(String)
 
-    sessions = relationship("LearningSession", back_populates="concept")
+    sessions = relationship("LearningSession", back_populates="concept", lazy="raise_on_sql")
 
 
 class LearningSession(Base):
     __tablename__ = "learning_sessions"
+    # A user's sessions in time order (B-tree scans serve DESC as well)
+    __table_args__ = (Index("ix_learning_sessions_user_start", "user_id", "session_start"),)
 
     session_id = Column(String(50), primary_key=True)
     user_id = Column(String(50), ForeignKey("users.user_id"))
@@ -51,13 +57,15 @@ class LearningSession(Base):
     device_type = Column(String(20))
     ip_address = Column(String(45))
 
-    user = relationship("User", back_populates="sessions")
-    concept = relationship("Concept", back_populates="sessions")
-    interactions = relationship("StepInteraction", back_populates="session")
+    user = relationship("User", back_populates="sessions", lazy="raise_on_sql")
+    concept = relationship("Concept", back_populates="sessions", lazy="raise_on_sql")
+    interactions = relationship("StepInteraction", back_populates="session", lazy="raise_on_sql")
 
 
 class ConceptMastery(Base):
     __tablename__ = "concept_mastery"
+    # Trackers look mastery up by (user_id, concept_id)
+    __table_args__ = (Index("ix_concept_mastery_user_concept", "user_id", "concept_id"),)
 
     mastery_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(50), ForeignKey("users.user_id"))
@@ -72,6 +80,7 @@ class ConceptMastery(Base):
 
 class StepInteraction(Base):
     __tablename__ = "step_interactions"
+    __table_args__ = (Index("ix_step_interactions_session_step", "session_id", "step_number"),)
 
     interaction_id = Column(Integer, primary_key=True, autoincrement=True)
     session_id = Column(String(50), ForeignKey("learning_sessions.session_id"))
@@ -80,13 +89,17 @@ class StepInteraction(Base):
     end_time = Column(DateTime(timezone=True))
     duration = Column(Integer)
     success = Column(Boolean)
-    metadata = Column(JSON)  # Changed from JSONB to JSON for SQLite compatibility
+    # "metadata" is reserved on declarative classes, so the attribute is renamed;
+    # the column keeps its name. JSONB on Postgres, plain JSON on SQLite.
+    step_metadata = Column("metadata", JSON().with_variant(JSONB, "postgresql"))
 
-    session = relationship("LearningSession", back_populates="interactions")
+    session = relationship("LearningSession", back_populates="interactions", lazy="raise_on_sql")
 
 
 class Step3Error(Base):
     __tablename__ = "step3_errors"
+    # Per-user error history, newest first
+    __table_args__ = (Index("ix_step3_errors_user_time", "user_id", "timestamp"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(50), ForeignKey("users.user_id"))
@@ -106,6 +119,7 @@ class Step3Error(Base):
 
 class Step4Error(Base):
     __tablename__ = "step4_errors"
+    __table_args__ = (Index("ix_step4_errors_user_time", "user_id", "timestamp"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(50), ForeignKey("users.user_id"))
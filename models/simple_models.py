@@ -1,4 +1,6 @@
-from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, ForeignKey, JSON, func
+from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, ForeignKey, Index, JSON, func
+
+from sqlalchemy.dialects.postgresql import JSONB
 
 from database import Base
 
@@ -33,6 +35,7 @@ class Concept(Base):
 
 class LearningSession(Base):
     __tablename__ = "learning_sessions"
+    __table_args__ = (Index("ix_learning_sessions_user_start", "user_id", "session_start"),)
 
     session_id = Column(String(50), primary_key=True)
     user_id = Column(String(50), ForeignKey("users.user_id"))
@@ -49,6 +52,7 @@ class LearningSession(Base):
 
 class ConceptMastery(Base):
     __tablename__ = "concept_mastery"
+    __table_args__ = (Index("ix_concept_mastery_user_concept", "user_id", "concept_id"),)
 
     mastery_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String(50), ForeignKey("users.user_id"))
@@ -62,6 +66,7 @@ class ConceptMastery(Base):
 
 class StepInteraction(Base):
     __tablename__ = "step_interactions"
+    __table_args__ = (Index("ix_step_interactions_session_step", "session_id", "step_number"),)
 
     interaction_id = Column(Integer, primary_key=True, autoincrement=True)
     session_id = Column(String(50), ForeignKey("learning_sessions.session_id"))
@@ -70,4 +75,5 @@ class StepInteraction(Base):
     end_time = Column(DateTime)
     duration = Column(Integer)
     success = Column(Boolean)
-    metadata = Column(JSON) 
\ No newline at end of file
+    # "metadata" is reserved on declarative classes; the column keeps its name
+    step_metadata = Column("metadata", JSON().with_variant(JSONB, "postgresql"))
\ No newline at end of file
@@ -2,17 +2,82 @@
 AI service for handling language model interactions.
 """
 
+import asyncio
+import hashlib
 import json
-from typing import Optional, Dict, Any
-from config.settings import CLIENT, MODEL
+import threading
+from typing import Optional, Dict, Any, AsyncIterator
+from cachetools import TTLCache
+from config.settings import CLIENT, ASYNC_CLIENT, MODEL, LLM_CACHE_SIZE, LLM_CACHE_TTL, DISABLE_LLM_CACHE
+
+# OpenRouter 需要的额外请求头，以通过 401 验证
+EXTRA_HEADERS = {
+    "HTTP-Referer": "http://localhost:3000",
+    "X-Title": "PedagogicalAI"
+}
+
+# Responses for prompts that are identical across users (poems, hints on a shared
+# schema). Shared by the sync and async paths, hence a plain threading lock.
+_response_cache: TTLCache = TTLCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL)
+_response_cache_lock = threading.Lock()
+
+
+def _response_format(json_mode: bool, json_schema: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """A json_schema (``{"name": ..., "schema": ...}``) constrains the reply at decode
+    time; plain json_mode only asks for some JSON object."""
+    if json_schema:
+        return {"type": "json_schema", "json_schema": json_schema}
+    if json_mode:
+        return {"type": "json_object"}
+    return None
+
+
+def _cache_key(system_prompt: str, user_prompt: str, response_format: Optional[Dict[str, Any]], temperature: float) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    fmt = json.dumps(response_format, sort_keys=True) if response_format else ""
+    for part in (MODEL, system_prompt, user_prompt, fmt, str(temperature)):
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _cache_get(key: str) -> Optional[str]:
+    with _response_cache_lock:
+        return _response_cache.get(key)
+
+
+def _cache_put(key: str, content: Optional[str]) -> None:
+    if content:  # never cache failures / empty replies
+        with _response_cache_lock:
+            _response_cache[key] = content
+
+
+# Cacheable async requests currently waiting on the model, keyed like the cache,
+# so concurrent identical calls share a single upstream request.
+_inflight: Dict[str, asyncio.Future] = {}
 
 
 class AIService:
     """Service for handling AI/LLM interactions."""
     
     @staticmethod
-    def get_response(system_prompt: str, user_prompt: str, json_mode: bool = False, temperature: float = 0.3) -> Optional[str]:
-        """Get a response from the language model."""
+    def get_response(system_prompt: str, user_prompt: str, json_mode: bool = False, temperature: float = 0.3,
+                     cache: bool = False, json_schema: Optional[Dict[str, Any]] = None,
+                     cache_key: Optional[str] = None) -> Optional[str]:
+        """Get a response from the language model.
+
+        With ``cache=True`` an identical earlier response (same model, prompts and
+        settings) is reused for up to LLM_CACHE_TTL seconds. ``cache_key`` replaces
+        the user prompt in the cache key only (e.g. a normalized form of it); the
+        model always receives ``user_prompt`` unchanged.
+        """
+        response_format = _response_format(json_mode, json_schema)
+        key = None
+        if cache and not DISABLE_LLM_CACHE:
+            key = _cache_key(system_prompt, cache_key or user_prompt, response_format, temperature)
+            cached = _cache_get(key)
+            if cached is not None:
+                return cached
         print("\n🧠 Agent is thinking...")
         try:
             response_kwargs = {
@@ -22,23 +87,103 @@ class AIService:
                     {"role": "user", "content": user_prompt}
                 ],
                 "temperature": temperature,
-                # OpenRouter 需要的额外请求头，以通过 401 验证
-                "extra_headers": {
-                    "HTTP-Referer": "http://localhost:3000",
-                    "X-Title": "PedagogicalAI"
-                }
+                "extra_headers": EXTRA_HEADERS
             }
-            if json_mode:
-                response_kwargs["response_format"] = {"type": "json_object"}
+            if response_format:
+                response_kwargs["response_format"] = response_format
 
             response = CLIENT.chat.completions.create(**response_kwargs)
             content = response.choices[0].message.content
             print("✅ Agent responded.")
+            if key is not None:
+                _cache_put(key, content)
+            return content
+        except Exception as e:
+            print(f"\n[Error: Could not get AI response. Reason: {e}]")
+            return None
+    
+    @staticmethod
+    async def get_response_async(system_prompt: str, user_prompt: str, json_mode: bool = False, temperature: float = 0.3,
+                                 cache: bool = False, json_schema: Optional[Dict[str, Any]] = None,
+                                 cache_key: Optional[str] = None) -> Optional[str]:
+        """Async version of get_response for the API server; doesn't tie up a worker thread while waiting."""
+        response_format = _response_format(json_mode, json_schema)
+        if not cache or DISABLE_LLM_CACHE:
+            return await AIService._complete_async(system_prompt, user_prompt, response_format, temperature)
+
+        key = _cache_key(system_prompt, cache_key or user_prompt, response_format, temperature)
+        while True:
+            cached = _cache_get(key)
+            if cached is not None:
+                return cached
+
+            # Single-flight: join an identical request that is already in progress
+            pending = _inflight.get(key)
+            if pending is None:
+                break
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # Only our own cancellation propagates; if the leading request
+                # was cancelled (client gone, prefetch dropped), take over.
+                if not pending.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        _inflight[key] = future
+        try:
+            content = await AIService._complete_async(system_prompt, user_prompt, response_format, temperature)
+            _cache_put(key, content)
+            future.set_result(content)
             return content
+        finally:
+            _inflight.pop(key, None)
+            if not future.done():  # the leading request was cancelled
+                future.cancel()
+
+    @staticmethod
+    async def _complete_async(system_prompt: str, user_prompt: str, response_format: Optional[Dict[str, Any]],
+                              temperature: float) -> Optional[str]:
+        """Single uncached chat completion request."""
+        try:
+            response_kwargs = {
+                "model": MODEL,
+                "messages": [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                "temperature": temperature,
+                "extra_headers": EXTRA_HEADERS
+            }
+            if response_format:
+                response_kwargs["response_format"] = response_format
+
+            response = await ASYNC_CLIENT.chat.completions.create(**response_kwargs)
+            return response.choices[0].message.content
         except Exception as e:
             print(f"\n[Error: Could not get AI response. Reason: {e}]")
             return None
     
+    @staticmethod
+    async def stream_response(system_prompt: str, user_prompt: str, temperature: float = 0.3) -> AsyncIterator[str]:
+        """Stream a response from the language model, yielding text deltas as they arrive."""
+        try:
+            stream = await ASYNC_CLIENT.chat.completions.create(
+                model=MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=temperature,
+                extra_headers=EXTRA_HEADERS,
+                stream=True
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            print(f"\n[Error: Could not stream AI response. Reason: {e}]")
+    
     @staticmethod
     def parse_json_response(response_str: str) -> Optional[Dict[str, Any]]:
         """Parse JSON response from AI and handle errors gracefully."""
@@ -22,8 +22,10 @@ def save_step3_error(
         - time_elapsed:     int (seconds)
         - hints_used:       int
     """
-    own_session = db is None
-    session = db or get_db_session().__enter__()
+    if db is None:
+        # Borrow a pooled connection only for the duration of this write
+        with get_db_session() as session:
+            return save_step3_error(user_id, concept, attempt_data, gpt_analysis, db=session)
 
     record = Step3Error(
         user_id=user_id,
@@ -35,11 +37,8 @@ def save_step3_error(
         hints_used=attempt_data.get("hints_used", 0),
         final_success=gpt_analysis.get("is_correct", False),
     )
-    session.add(record)
-
-    if own_session:
-        session.commit()
-        session.close()
+    db.add(record)
+    db.flush()  # assigns record.id; the caller's session commits
 
     return record.id
 
@@ -63,8 +62,10 @@ def save_step4_error(
         - solution:        str
         - attempt_number:  int
     """
-    own_session = db is None
-    session = db or get_db_session().__enter__()
+    if db is None:
+        # Borrow a pooled connection only for the duration of this write
+        with get_db_session() as session:
+            return save_step4_error(user_id, concept, problem_data, attempt_data, gpt_analysis, db=session)
 
     record = Step4Error(
         user_id=user_id,
@@ -77,10 +78,7 @@ def save_step4_error(
         attempts=attempt_data["attempt_number"],
         final_success=gpt_analysis.get("is_correct", False),
     )
-    session.add(record)
-
-    if own_session:
-        session.commit()
-        session.close()
+    db.add(record)
+    db.flush()  # assigns record.id; the caller's session commits
 
     return record.id 
\ No newline at end of file
@@ -6,7 +6,7 @@ from __future__ import annotations
 或者在初始化时传入凭据路径。
 """
 
-from typing import Any, Optional
+from typing import Any, Callable, Iterator, Optional
 import os
 import json
 
@@ -67,26 +67,78 @@ def get_client() -> firestore.Client:
     return _client
 
 
+def close_client() -> None:
+    """关闭 Firestore Client 的 gRPC 通道（服务关闭时调用），未创建时不做任何事。"""
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
 # ---------------------------------------------------------------------------
 # CRUD helpers
 # ---------------------------------------------------------------------------
 
 
-def add_document(collection_path: str, data: dict[str, Any], doc_id: str | None = None) -> str:
-    """向指定 collection 写入文档，返回文档 id。"""
+def new_batch() -> firestore.WriteBatch:
+    """创建 WriteBatch：传给 add_document / update_document 的写入会在 commit() 时一次性原子提交。"""
+    return get_client().batch()
+
+
+def add_document(
+    collection_path: str,
+    data: dict[str, Any],
+    doc_id: str | None = None,
+    batch: firestore.WriteBatch | None = None,
+) -> str:
+    """向指定 collection 写入文档，返回文档 id。传入 batch 时只加入批处理，由调用方 commit。"""
     client = get_client()
     coll_ref = client.collection(collection_path)
     if doc_id is None:
         doc_ref = coll_ref.document()
     else:
         doc_ref = coll_ref.document(doc_id)
-    doc_ref.set(data, merge=True)
+    if batch is not None:
+        batch.set(doc_ref, data, merge=True)
+    else:
+        doc_ref.set(data, merge=True)
     return doc_ref.id
 
 
-def update_document(collection_path: str, doc_id: str, data: dict[str, Any]) -> None:
+def update_document(
+    collection_path: str,
+    doc_id: str,
+    data: dict[str, Any],
+    batch: firestore.WriteBatch | None = None,
+) -> None:
     client = get_client()
-    client.collection(collection_path).document(doc_id).set(data, merge=True)
+    doc_ref = client.collection(collection_path).document(doc_id)
+    if batch is not None:
+        batch.set(doc_ref, data, merge=True)
+    else:
+        doc_ref.set(data, merge=True)
+
+
+def transactional_update(
+    collection_path: str,
+    doc_id: str,
+    update_fn: Callable[[Optional[dict[str, Any]]], dict[str, Any]],
+) -> dict[str, Any]:
+    """在事务中读取文档，并以 merge 方式写回 update_fn(旧数据或 None) 的结果。
+
+    读-改-写在一个事务内完成，并发更新冲突时由客户端自动重试；返回写入的数据。
+    """
+    client = get_client()
+    doc_ref = client.collection(collection_path).document(doc_id)
+
+    @firestore.transactional
+    def _run(transaction: firestore.Transaction) -> dict[str, Any]:
+        snap = doc_ref.get(transaction=transaction)
+        data = update_fn(snap.to_dict() if snap.exists else None)
+        transaction.set(doc_ref, data, merge=True)
+        return data
+
+    return _run(client.transaction())
 
 
 def get_document(collection_path: str, doc_id: str) -> Optional[dict[str, Any]]:
@@ -95,6 +147,20 @@ def get_document(collection_path: str, doc_id: str) -> Optional[dict[str, Any]]:
     return snap.to_dict() if snap.exists else None
 
 
+def get_documents(paths: list[tuple[str, str]]) -> list[Optional[dict[str, Any]]]:
+    """一次 RPC（client.get_all）读取多个文档，按传入顺序返回，不存在的为 None。
+
+    `paths` 形如 [("concepts", concept_id), ("concept_mastery", mastery_id)]。
+    """
+    client = get_client()
+    refs = [client.collection(collection_path).document(doc_id) for collection_path, doc_id in paths]
+    snaps = {snap.reference.path: snap for snap in client.get_all(refs)}
+    return [
+        snaps[ref.path].to_dict() if ref.path in snaps and snaps[ref.path].exists else None
+        for ref in refs
+    ]
+
+
 def delete_document(collection_path: str, doc_id: str) -> None:
     client = get_client()
     client.collection(collection_path).document(doc_id).delete()
@@ -106,6 +172,65 @@ def list_collection(collection_path: str) -> list[dict[str, Any]]:
     return [doc.to_dict() | {"id": doc.id} for doc in coll_ref.stream()]
 
 
+def query_collection(
+    collection_path: str,
+    filters: list[tuple[str, str, Any]],
+    order_by: str | None = None,
+    descending: bool = False,
+    limit: int | None = None,
+    fields: list[str] | None = None,
+) -> list[dict[str, Any]]:
+    """按条件查询 collection，过滤/排序/limit 都在服务端完成。
+
+    `filters` 形如 [("user_id", "==", uid)]。等值 + 排序/范围的组合需要复合索引，
+    见项目根目录的 firestore.indexes.json。`fields` 给出时只返回这些字段（服务端投影）。
+    """
+    return list(stream_collection(collection_path, filters, order_by, descending, limit, fields))
+
+
+def stream_collection(
+    collection_path: str,
+    filters: list[tuple[str, str, Any]],
+    order_by: str | None = None,
+    descending: bool = False,
+    limit: int | None = None,
+    fields: list[str] | None = None,
+) -> Iterator[dict[str, Any]]:
+    """与 query_collection 相同，但边接收边逐个产出文档，不把结果集整体放进内存。"""
+    client = get_client()
+    query = client.collection(collection_path)
+    for field, op, value in filters:
+        query = query.where(field, op, value)
+    if order_by:
+        direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+        query = query.order_by(order_by, direction=direction)
+    if limit:
+        query = query.limit(limit)
+    if fields:
+        query = query.select(fields)
+    for doc in query.stream():
+        yield doc.to_dict() | {"id": doc.id}
+
+
+def count_documents(collection_path: str, field: str, value: Any) -> int:
+    """统计 collection 中 `field == value` 的文档数量（服务端聚合，不拉取文档内容）。"""
+    client = get_client()
+    query = client.collection(collection_path).where(field, "==", value)
+    result = query.count().get()
+    return int(result[0][0].value) if result else 0
+
+
+def average_field(collection_path: str, filters: list[tuple[str, str, Any]], field: str) -> Optional[float]:
+    """对满足 `filters` 的文档求 `field` 的平均值（服务端聚合）；没有数值时返回 None。"""
+    client = get_client()
+    query = client.collection(collection_path)
+    for filter_field, op, value in filters:
+        query = query.where(filter_field, op, value)
+    result = query.avg(field).get()
+    value = result[0][0].value if result else None
+    return float(value) if value is not None else None
+
+
 # ---------------------------------------------------------------------------
 # Convenience helpers for本项目中的常用结构（users/…）
 # ---------------------------------------------------------------------------
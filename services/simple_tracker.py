@@ -28,26 +28,24 @@ class SimpleTracker:
     def start_concept(self, user_id: str, topic: str) -> str:
         """Initialize concept tracking and create a new learning session."""
         with get_db_session() as db:
-            # Ensure user exists
-            user = db.query(User).filter_by(user_id=user_id).first()
-            if not user:
+            # Ensure user exists (existence checks select only the key column)
+            if db.query(User.user_id).filter_by(user_id=user_id).first() is None:
                 user = User(user_id=user_id, name="Test User")
                 db.add(user)
                 db.commit()
 
             # Ensure concept exists
             concept_id = topic.upper().replace(" ", "_")
-            concept = db.query(Concept).filter_by(concept_id=concept_id).first()
-            if not concept:
+            if db.query(Concept.concept_id).filter_by(concept_id=concept_id).first() is None:
                 concept = Concept(concept_id=concept_id, concept_name=topic)
                 db.add(concept)
                 db.commit()
 
             # Get current mastery
-            mastery = db.query(ConceptMastery).filter_by(
+            mastery_level = db.query(ConceptMastery.mastery_level).filter_by(
                 user_id=user_id, concept_id=concept_id
-            ).first()
-            current_mastery = mastery.mastery_level if mastery else 0.0
+            ).limit(1).scalar()
+            current_mastery = mastery_level if mastery_level is not None else 0.0
 
             # Create session
             session_id = self._default_id()
@@ -82,8 +80,10 @@ class SimpleTracker:
                 step_number=step_number,
                 success=success,
                 duration=duration,
-                metadata=metadata,
+                step_metadata=metadata,
             )
             db.add(interaction)
             db.commit()
+            # get_db_session sessions don't expire on commit: the id filled in by
+            # the INSERT's RETURNING is still loaded, no refresh SELECT
             return interaction.interaction_id 
\ No newline at end of file
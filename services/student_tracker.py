@@ -4,7 +4,7 @@ from typing import Optional, Any, Dict
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import NoResultFound
 
-from database import get_db_session
+from database import SessionLocal
 from models.db_models import (
     User,
     Concept,
@@ -18,9 +18,11 @@ class StudentTracker:
     """Service that handles user model triggers and logs interactions."""
 
     def __init__(self, db: Optional[Session] = None):
-        # Allow manual session injection for tests. Otherwise open context manager.
+        # Allow manual session injection for tests. Otherwise own a session for the
+        # tracker's lifetime; since it is long-lived, keep expire-on-commit so
+        # loaded objects are refreshed instead of going stale across commits.
         self._external_session = db is not None
-        self.db = db or get_db_session().__enter__()
+        self.db = db or SessionLocal(expire_on_commit=True)
 
     # ---------------------------------------------------------------------
     # Utilities
@@ -70,11 +72,15 @@ class StudentTracker:
             step_number=step_number,
             success=success,
             duration=duration,
-            metadata=metadata,
+            step_metadata=metadata,
         )
         self.db.add(interaction)
+        # Take the RETURNING-filled id at flush; after commit() reading it would
+        # reload the row (the tracker's own session expires on commit)
+        self.db.flush()
+        interaction_id = interaction.interaction_id
         self._commit()
-        return interaction.interaction_id
+        return interaction_id
 
     # ------------------------------------------------------------------
     # Internal helpers
@@ -101,12 +107,13 @@ class StudentTracker:
         return concept
 
     def _get_current_mastery(self, user_id: str, concept_id: str) -> float:
-        mastery = (
-            self.db.query(ConceptMastery)
+        mastery_level = (
+            self.db.query(ConceptMastery.mastery_level)
             .filter_by(user_id=user_id, concept_id=concept_id)
-            .first()
+            .limit(1)
+            .scalar()
         )
-        return mastery.mastery_level if mastery else 0.0
+        return mastery_level if mastery_level is not None else 0.0
 
     def _commit(self):
         if not self._external_session:
@@ -0,0 +1,102 @@
+"""
+pytest tests for the single-flight behaviour of AIService.get_response_async:
+concurrent identical cached calls share one upstream request, and a cancelled
+leader doesn't fail the callers that joined it.
+"""
+
+import asyncio
+import os
+import sys
+sys.path.append('.')
+
+from cachetools import TTLCache
+
+os.environ.setdefault("OPENROUTER_API_KEY", "test-key")
+
+from services import ai_service
+from services.ai_service import AIService
+
+
+def _install_fake_model(monkeypatch, reply, delay=0.05):
+    """Replace the upstream call with a counting fake (undone after the test); returns the call list."""
+    calls = []
+
+    async def fake_complete(system_prompt, user_prompt, response_format, temperature):
+        calls.append(user_prompt)
+        await asyncio.sleep(delay)
+        return reply
+
+    monkeypatch.setattr(ai_service, "_response_cache", TTLCache(maxsize=16, ttl=60))
+    monkeypatch.setattr(ai_service, "_inflight", {})
+    monkeypatch.setattr(ai_service, "DISABLE_LLM_CACHE", False)
+    monkeypatch.setattr(AIService, "_complete_async", staticmethod(fake_complete))
+    return calls
+
+
+def test_concurrent_calls_share_one_request(monkeypatch):
+    calls = _install_fake_model(monkeypatch, "answer")
+
+    async def run():
+        return await asyncio.gather(
+            *(AIService.get_response_async("sys", "same prompt", cache=True) for _ in range(5))
+        )
+
+    assert asyncio.run(run()) == ["answer"] * 5
+    assert len(calls) == 1
+    assert not ai_service._inflight
+
+
+def test_leader_failure_is_shared_but_not_cached(monkeypatch):
+    # _complete_async reports upstream errors as None
+    calls = _install_fake_model(monkeypatch, None)
+
+    async def run():
+        return await asyncio.gather(
+            *(AIService.get_response_async("sys", "same prompt", cache=True) for _ in range(3))
+        )
+
+    assert asyncio.run(run()) == [None] * 3
+    assert len(calls) == 1
+    assert not ai_service._inflight
+    assert not ai_service._response_cache
+
+
+def test_cancelled_leader_does_not_fail_joined_callers(monkeypatch):
+    calls = _install_fake_model(monkeypatch, "answer")
+
+    async def run():
+        leader = asyncio.create_task(AIService.get_response_async("sys", "same prompt", cache=True))
+        await asyncio.sleep(0)  # leader registers its in-flight future
+        followers = [
+            asyncio.create_task(AIService.get_response_async("sys", "same prompt", cache=True))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0.01)  # followers join the leader
+        leader.cancel()
+        results = await asyncio.gather(*followers)
+        return leader, results
+
+    leader, results = asyncio.run(run())
+    assert leader.cancelled()
+    assert results == ["answer"] * 3
+    # One follower took over as the new leader; the others joined it
+    assert len(calls) == 2
+    assert not ai_service._inflight
+
+
+def test_cancelled_follower_only_cancels_itself(monkeypatch):
+    calls = _install_fake_model(monkeypatch, "answer")
+
+    async def run():
+        leader = asyncio.create_task(AIService.get_response_async("sys", "same prompt", cache=True))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(AIService.get_response_async("sys", "same prompt", cache=True))
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        return await leader, follower
+
+    result, follower = asyncio.run(run())
+    assert result == "answer"
+    assert follower.cancelled()
+    assert len(calls) == 1
+
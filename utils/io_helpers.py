@@ -5,6 +5,9 @@ Input/Output helper functions for user interaction.
 import sys
 from config.settings import EXIT_COMMANDS, HEADER_SEPARATOR
 
+# Header layout, built once; print_header only fills in the title
+_HEADER_TEMPLATE = "\n" + HEADER_SEPARATOR + "\n🔹 {}\n" + HEADER_SEPARATOR
+
 
 def get_user_input(prompt: str) -> str:
     """Get user input and handle exit command."""
@@ -17,6 +20,4 @@ def get_user_input(prompt: str) -> str:
 
 def print_header(title: str) -> None:
     """Prints a formatted header for each step."""
-    print("\n" + HEADER_SEPARATOR)
-    print(f"🔹 {title}")
-    print(HEADER_SEPARATOR) 
\ No newline at end of file
+    print(_HEADER_TEMPLATE.format(title)) 
\ No newline at end of file
@@ -0,0 +1,16 @@
+"""
+Time helper functions shared by the API and the controllers.
+"""
+
+import time
+from datetime import datetime
+
+
+def now_stamp() -> tuple[int, str]:
+    """Read the clock once and return (epoch milliseconds, ISO-8601 local time).
+
+    The millisecond value is used in document IDs, the ISO string for the
+    stored `timestamp` fields, so both describe the same instant.
+    """
+    t = time.time()
+    return int(t * 1000), datetime.fromtimestamp(t).isoformat()